@@ -0,0 +1,456 @@
+#!/usr/bin/python
+"""
+Benchmarks for the Kuao lexer, parser, evaluator and startup.
+
+Every workload runs in a fresh interpreter process, so the memory peak and
+the definitions of one workload never leak into the next. Timings are the
+wall time of each repeat after the warmup runs. The peak is the most memory
+tracemalloc saw in use during one run. Without tracemalloc, as on a plain
+Python 2, it is how far that run raised the process's maximum RSS.
+
+  python bench/bench.py                      # run every workload
+  python bench/bench.py fib loop -r 5        # some workloads, 5 repeats
+  python bench/bench.py -p fib.n=20          # override a parameter
+  python bench/bench.py --json new.json --compare old.json
+"""
+
+import os
+import gc
+import sys
+import glob
+import json
+import atexit
+import time
+import timeit
+import argparse
+import random
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+from StringIO import StringIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KUAO = os.path.join(ROOT, 'kuao.py')
+BOOT = os.path.join(ROOT, 'boot.ss')
+
+sys.path.insert(0, ROOT)
+import kuao
+
+try:
+  import tracemalloc
+except ImportError:
+  # Python 2 only has it through the pytracemalloc backport
+  tracemalloc = None
+
+workloads = {}
+order = []
+
+def workload(name, **params):
+  """
+  Registers a workload. The decorated function gets the parameters, does its
+  setup and returns a function of no arguments that runs the timed part.
+  """
+  def wrapper(fn, name=name):
+    workloads[name] = (fn, params)
+    order.append(name)
+    return fn
+  return wrapper
+
+def forms(src):
+  p = kuao.Parser(kuao.Lexer(StringIO(src)))
+  ret = []
+  while True:
+    sexp = p.sexp()
+    if sexp is None:
+      return ret
+    ret.append(sexp)
+
+def load(src):
+  for sexp in forms(src):
+    kuao.tramp(kuao.keval(kuao.toplevel, sexp))
+
+def evaluator(src):
+  """Parses src once and returns a function that evaluates it."""
+  fs = forms(src)
+  def run():
+    for sexp in fs:
+      kuao.tramp(kuao.keval(kuao.toplevel, sexp))
+  return run
+
+def parses(src):
+  try:
+    forms(src)
+    return True
+  except (kuao.ParserException, kuao.LexerException):
+    return False
+
+def source(mb):
+  """Roughly mb megabytes of Kuao code made from the boot file and tests."""
+  files = [BOOT] + sorted(glob.glob(os.path.join(ROOT, 'tests', '*.ss')))
+  # Some tests are broken on purpose, to check how errors are reported
+  chunk = ''.join(src for src in (open(f).read() for f in files) if parses(src))
+  return chunk * (int(mb * (1 << 20)) / len(chunk) + 1)
+
+IOTA = """
+(define (iota n)
+  (define (helper i acc)
+    (if (= i 0)
+        acc
+        (helper (- i 1) (cons i acc))))
+  (helper n '()))
+"""
+
+@workload('startup')
+def startup():
+  cmd = [sys.executable, KUAO, os.devnull]
+  return lambda: subprocess.check_call(cmd)
+
+@workload('boot')
+def boot():
+  return lambda: kuao.run(open(BOOT), BOOT)
+
+@workload('lex', mb=2)
+def lex(mb):
+  src = source(mb)
+  def run():
+    for tok in kuao.Lexer(StringIO(src)).tokens():
+      pass
+  return run
+
+@workload('parse', mb=2)
+def parse(mb):
+  src = source(mb)
+  return lambda: forms(src)
+
+@workload('cache-load', mb=2)
+def cacheload(mb):
+  # Compare with parse, the same source read from its cache file instead
+  src = source(mb)
+  key = kuao.cachekey(StringIO(src))
+  encoder = kuao.Encoder()
+  for sexp in forms(src):
+    encoder.add(sexp, (1, 1))
+  fd, path = tempfile.mkstemp(suffix='.kc')
+  os.close(fd)
+  atexit.register(os.remove, path)
+  kuao.savecache(path, encoder.dumps(key))
+  # Forms are decoded as they are asked for, so ask for them all
+  return lambda: list(kuao.loadcache(path, key))
+
+@workload('fib', n=25)
+def fib(n):
+  load("""
+  (define (fib n)
+    (if (< n 2)
+        n
+        (+ (fib (- n 1)) (fib (- n 2)))))
+  """)
+  return evaluator('(fib %d)' % n)
+
+@workload('loop', n=1000000)
+def loop(n):
+  load("""
+  (define (loop n)
+    (if (= n 0)
+        0
+        (loop (- n 1))))
+  """)
+  return evaluator('(loop %d)' % n)
+
+@workload('map', n=100000)
+def kmap(n):
+  load(IOTA)
+  load('(define xs (iota %d))' % n)
+  return evaluator('(map (lambda (x) (+ x 1)) xs)')
+
+@workload('foldl', n=100000)
+def foldl(n):
+  load(IOTA)
+  load('(define xs (iota %d))' % n)
+  return evaluator('(foldl + 0 xs)')
+
+@workload('filter', n=10000)
+def kfilter(n):
+  # filter is built on foldr, which recurses once per element
+  load(IOTA)
+  load('(define xs (iota %d))' % n)
+  return evaluator('(filter (lambda (x) (< x %d)) xs)' % (n / 2))
+
+@workload('macros', n=20000, flat=True)
+def macros(n, flat):
+  kuao.flatclosures = flat
+  load("""
+  (define (macro-loop n acc)
+    (if (= n 0)
+        acc
+        (let ((m (- n 1))
+              (a (+ acc 1)))
+          (when (> a 0)
+            (unless (< a 0)
+              (macro-loop m a))))))
+  """)
+  return evaluator('(macro-loop %d 0)' % n)
+
+@workload('quasiquote', n=20000)
+def quasiquote(n):
+  load("""
+  (define (qq-loop n acc)
+    (if (= n 0)
+        acc
+        (qq-loop (- n 1)
+                 `(,n (x ,@(list n n) y) ,(car acc) . z))))
+  """)
+  return evaluator("(qq-loop %d '(0))" % n)
+
+@workload('cons-list', n=1000000)
+def conslist(n):
+  # The list is kept until the next run, so its cells make up the peak
+  load(IOTA)
+  load("(define xs '())")
+  return evaluator('(set! xs (iota %d))' % n)
+
+def words(n, distinct):
+  rand = random.Random(n)
+  return "(define words '(%s))" % ' '.join(
+      'w%d' % rand.randrange(distinct) for i in range(n))
+
+@workload('wordcount-hash', n=2000, distinct=100)
+def wordcounthash(n, distinct):
+  load(words(n, distinct))
+  load("""
+  (define (count-words words)
+    (foldl (lambda (table w)
+             (hash-set! table w (+ 1 (hash-ref table w 0)))
+             table)
+           (make-hash-table eqv?)
+           words))
+  """)
+  return evaluator('(count-words words)')
+
+@workload('wordcount-alist', n=2000, distinct=100)
+def wordcountalist(n, distinct):
+  load(words(n, distinct))
+  load("""
+  (define (bump alist w)
+    (if (null? alist)
+        (list (cons w 1))
+        (if (eqv? (caar alist) w)
+            (cons (cons w (+ (cdr (car alist)) 1)) (cdr alist))
+            (cons (car alist) (bump (cdr alist) w)))))
+  (define (count-words words)
+    (foldl bump '() words))
+  """)
+  return evaluator('(count-words words)')
+
+@workload('closures', n=1000000, flat=True)
+def closures(n, flat):
+  kuao.flatclosures = flat
+  load("""
+  (define (make-closures n x)
+    (if (= n 0)
+        x
+        (make-closures (- n 1) ((lambda (y) (+ x y)) 1))))
+  """)
+  return evaluator('(make-closures %d 0)' % n)
+
+@workload('closure-retention', n=1000, size=200, flat=True)
+def closureretention(n, size, flat):
+  # Every closure is made in a frame holding a list it never refers to
+  kuao.flatclosures = flat
+  load(IOTA)
+  load("""
+  (define (make-adder i size)
+    (define garbage (iota size))
+    (lambda (x) (+ x i)))
+  (define (make-adders n size acc)
+    (if (= n 0)
+        acc
+        (make-adders (- n 1) size (cons (make-adder n size) acc))))
+  (define adders '())
+  """)
+  return evaluator('(set! adders (make-adders %d %d (quote ())))' % (n, size))
+
+def deep(fn, *args):
+  """
+  Calls fn on a thread with a large stack. Non-tail calls recurse in the
+  evaluator, so list workloads need far more than the default stack.
+  """
+  result = []
+  def target():
+    try:
+      result.append((True, fn(*args)))
+    except BaseException as e:
+      result.append((False, e))
+  sys.setrecursionlimit(1000000)
+  threading.stack_size(512 << 20)
+  t = threading.Thread(target=target)
+  t.start()
+  t.join()
+  ok, value = result[0]
+  if not ok:
+    raise value
+  return value
+
+def maxrss():
+  """The most memory this process has held so far, in KB."""
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure(name, params, repeat, warmup):
+  fn, defaults = workloads[name]
+  run = fn(**params)
+  # Memory gets a run of its own, straight after the setup, while nothing
+  # else of the workload is alive. Tracing slows everything down
+  gc.collect()
+  if tracemalloc:
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+  else:
+    # How far the run pushes the high-water mark past the setup's
+    before = maxrss()
+    run()
+    peak = (maxrss() - before) * 1024
+  for i in range(warmup):
+    run()
+  times = []
+  for i in range(repeat):
+    gc.collect()
+    start = timeit.default_timer()
+    run()
+    times.append(timeit.default_timer() - start)
+  times.sort()
+  return {
+    'name': name,
+    'params': params,
+    'times': times,
+    'min': times[0],
+    'median': times[len(times) / 2],
+    'peak_bytes': peak,
+    'maxrss_kb': maxrss()
+  }
+
+def child(name, params, repeat, warmup):
+  """Runs one workload in this process and writes its result as JSON."""
+  # Anything the workload displays must not end up in the JSON
+  kuao.output = kuao.OutputPort(open(os.devnull, 'w'), os.devnull)
+  kuao.run(open(BOOT), BOOT)
+  result = deep(measure, name, params, repeat, warmup)
+  json.dump(result, sys.stdout)
+
+def spawn(name, params, repeat, warmup):
+  cmd = [sys.executable, os.path.abspath(__file__), '--child', name,
+         '--params', json.dumps(params),
+         '--repeat', str(repeat), '--warmup', str(warmup)]
+  return json.loads(subprocess.check_output(cmd))
+
+def parseparams(specs):
+  """Turns ['fib.n=20', ...] into {'fib': {'n': 20}, ...}."""
+  ret = {}
+  for spec in specs:
+    key, _, value = spec.partition('=')
+    name, _, param = key.partition('.')
+    if not param or name not in workloads:
+      raise SystemExit("bad parameter '%s', expected workload.param=value" % spec)
+    try:
+      value = json.loads(value)
+    except ValueError:
+      pass
+    ret.setdefault(name, {})[param] = value
+  return ret
+
+def revision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                   stderr=open(os.devnull, 'w')).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def fmtparams(params):
+  return ','.join('%s=%s' % kv for kv in sorted(params.items())) or '-'
+
+def fmtbytes(n):
+  if n is None:
+    return '-'
+  for unit in ['B', 'KB', 'MB']:
+    if n < 1024:
+      return '%.1f%s' % (n, unit)
+    n /= 1024.0
+  return '%.1fGB' % n
+
+def key(result):
+  return result['name'], fmtparams(result['params'])
+
+def report(results, baseline=None):
+  base = dict((key(r), r) for r in baseline['results']) if baseline else {}
+  header = '%-16s %-20s %10s %10s %10s %10s' % \
+      ('workload', 'params', 'min', 'median', 'peak', 'maxrss')
+  if base:
+    header += ' %8s' % 'vs base'
+  print header
+  for r in results:
+    line = '%-16s %-20s %9.4fs %9.4fs %10s %10s' % \
+        (r['name'], fmtparams(r['params']), r['min'], r['median'],
+         fmtbytes(r['peak_bytes']), fmtbytes(r['maxrss_kb'] * 1024))
+    if key(r) in base:
+      line += ' %7.2fx' % (r['median'] / base[key(r)]['median'])
+    print line
+
+def main():
+  opts = argparse.ArgumentParser(description='Kuao benchmarks')
+  opts.add_argument('names', nargs='*', metavar='workload',
+                    help='workloads to run, all if omitted')
+  opts.add_argument('-r', '--repeat', type=int, default=3)
+  opts.add_argument('-w', '--warmup', type=int, default=1)
+  opts.add_argument('-p', '--param', action='append', default=[],
+                    metavar='WORKLOAD.PARAM=VALUE')
+  opts.add_argument('--json', metavar='FILE',
+                    help='write the results as JSON to FILE, - for stdout')
+  opts.add_argument('--compare', metavar='FILE',
+                    help='show medians relative to an earlier JSON result')
+  opts.add_argument('--list', action='store_true',
+                    help='list workloads and their default parameters')
+  opts.add_argument('--child', help=argparse.SUPPRESS)
+  opts.add_argument('--params', help=argparse.SUPPRESS)
+  args = opts.parse_args()
+  if args.child:
+    child(args.child, json.loads(args.params), args.repeat, args.warmup)
+    return
+  if args.list:
+    for name in order:
+      print '%-16s %s' % (name, fmtparams(workloads[name][1]))
+    return
+  names = args.names or order
+  for name in names:
+    if name not in workloads:
+      raise SystemExit("unknown workload '%s'" % name)
+  overrides = parseparams(args.param)
+  results = []
+  for name in names:
+    params = dict(workloads[name][1])
+    params.update(overrides.get(name, {}))
+    results.append(spawn(name, params, args.repeat, args.warmup))
+  baseline = json.load(open(args.compare)) if args.compare else None
+  doc = {
+    'python': platform.python_version(),
+    'implementation': platform.python_implementation(),
+    'platform': platform.platform(),
+    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'revision': revision(),
+    'tracemalloc': tracemalloc is not None,
+    'repeat': args.repeat,
+    'warmup': args.warmup,
+    'results': results
+  }
+  if args.json == '-':
+    json.dump(doc, sys.stdout, indent=2)
+    print
+  else:
+    report(results, baseline)
+    if args.json:
+      json.dump(doc, open(args.json, 'w'), indent=2)
+
+if __name__ == '__main__':
+  main()
@@ -2,10 +2,17 @@
 
 import os
 import sys
+import time
 import string
+import array
+import marshal
+import hashlib
+import argparse
 import itertools as it
+from collections import OrderedDict
 
-class String:
+class String(object):
+  __slots__ = ('value',)
   def __init__(self, value):
     self.value = value
   def __str__(self):
@@ -13,9 +20,12 @@ class String:
   def eval(self, env):
     return self
 
-class Number:
+class Number(object):
+  __slots__ = ('value',)
   def __init__(self, value):
     self.value = value
+  def __hash__(self):
+    return hash(self.value)
   def __eq__(self, other):
    return isinstance(other, self.__class__) and self.value == other.value
   def __ne__(self, other):
@@ -25,7 +35,8 @@ class Number:
   def eval(self, env):
     return self
 
-class Symbol:
+class Symbol(object):
+  __slots__ = ('value',)
   def __init__(self, value):
     self.value = value
   def __hash__(self):
@@ -39,7 +50,8 @@ class Symbol:
   def eval(self, env):
     return env.lookup(self)
 
-class Boolean:
+class Boolean(object):
+  __slots__ = ('value',)
   def __init__(self, value):
     self.value = value
   def __str__(self):
@@ -78,10 +90,21 @@ class UndefinedType:
 
 Undef = UndefinedType()
 
-class Pair:
+class Pair(object):
+  # Lists are made of a great many of these, so no per cell __dict__
+  __slots__ = ('car', 'cdr')
   def __init__(self, car, cdr):
     self.car, self.cdr = car, cdr
-    self.proper = cdr is Null or (isinstance(cdr, Pair) and cdr.proper)
+  @property
+  def proper(self):
+    """
+    Whether the list ends in (). Walks the spine rather than keeping a flag in
+    every cell, code lists are short and list? has to walk in Scheme anyway.
+    """
+    cdr = self.cdr
+    while type(cdr) is Pair:
+      cdr = cdr.cdr
+    return cdr is Null
   def evlist(self, env):
     ecar = self.car.eval(env)
     if isinstance(self.cdr, Pair):
@@ -112,39 +135,52 @@ class Pair:
       car = cdr.car
       cdr = cdr.cdr
       yield car
-  def __str__(self):
-    spec = {
-        'unquote': ',',
-        'quasiquote': '`',
-        'quote': '\'',
-        'unquote-splicing': ',@'
-    }
-    def isspecial(sym):
-      if not isinstance(sym, Symbol):
-        return False
-      v = sym.value
-      return v == 'unquote' or v == 'quasiquote' or v == 'quote' or v == 'unquote-splicing'
-    def insides(car, cdr):
-      rep = ''
-      while True:
-        if isinstance(cdr, Pair):
-          if isspecial(car):
-            rep += spec[car.value]
-          else:
-            rep += str(car) + ' '
-          car = cdr.car
-          cdr = cdr.cdr
-        elif cdr is Null:
-          rep += str(car)
-          break
+  def write(self, port):
+    """Writes the printed form to port a piece at a time."""
+    car = self.car
+    cdr = self.cdr
+    special = isquote(car)
+    if not special:
+      port.write('(')
+    while True:
+      if isinstance(cdr, Pair):
+        if isquote(car):
+          port.write(QUOTES[car.value])
         else:
-          rep += str(car) + ' . ' + str(cdr)
-          break
-      return rep
-    if isspecial(self.car):
-      return insides(self.car, self.cdr)
-    else:
-      return '(' + insides(self.car, self.cdr) + ')'
+          writeobj(car, port)
+          port.write(' ')
+        car = cdr.car
+        cdr = cdr.cdr
+      elif cdr is Null:
+        writeobj(car, port)
+        break
+      else:
+        writeobj(car, port)
+        port.write(' . ')
+        writeobj(cdr, port)
+        break
+    if not special:
+      port.write(')')
+  def __str__(self):
+    sb = StringBuilder()
+    self.write(sb)
+    return sb.getvalue()
+
+QUOTES = {
+  'unquote': ',',
+  'quasiquote': '`',
+  'quote': '\'',
+  'unquote-splicing': ',@'
+}
+
+def isquote(sym):
+  return isinstance(sym, Symbol) and sym.value in QUOTES
+
+def writeobj(obj, port):
+  if isinstance(obj, Pair):
+    obj.write(port)
+  else:
+    port.write(str(obj))
 
 def checkproper(xs):
   if xs is not Null and not xs.proper:
@@ -178,10 +214,11 @@ class Recurse:
     return self.func(*self.args)
 
 class Closure:
-  def __init__(self, env, params, body):
+  def __init__(self, env, params, body, scope=None):
     self.env = env
     self.params = params
     self.body = body
+    self.scope = scope
     self.name = None
   def __str__(self):
     if not self.name:
@@ -202,15 +239,38 @@ def booleanp(e):
   return isinstance(e, Boolean)
 
 class Reader:
+  """
+  Reads a stream a character at a time, keeping track of the line and column
+  of the current character. The stream is pulled in a line at a time, at most
+  CHUNK bytes, so a form can be read as soon as its last line arrives and
+  memory stays bounded on unbounded input.
+  """
+  CHUNK = 1 << 16
   def __init__(self, strm):
     self.stream = strm
+    self.buf = ''
+    self.pos = 0
     self.ch = None
+    self.line = 1
+    self.col = 1
   def peek(self):
     if self.ch is None:
       self.nxt()
     return self.ch
   def nxt(self):
-    self.ch = self.stream.read(1)
+    if self.ch == '\n':
+      self.line += 1
+      self.col = 1
+    elif self.ch:
+      self.col += 1
+    if self.pos == len(self.buf):
+      self.buf = self.stream.readline(self.CHUNK)
+      self.pos = 0
+      if not self.buf:
+        self.ch = ''
+        return self.ch
+    self.ch = self.buf[self.pos]
+    self.pos += 1
     return self.ch
 
 class LexerException(Exception):
@@ -220,6 +280,8 @@ class Lexer:
   def __init__(self, strm):
     self.rdr = Reader(strm)
     self.buf = []
+    # Line and column where the last token started
+    self.where = (1, 1)
   def get(self):
     if self.buf:
       fst, rest = self.buf[0], self.buf[1:]
@@ -232,6 +294,7 @@ class Lexer:
   def token(self):
     r = self.rdr
     c = r.peek()
+    self.where = (r.line, r.col)
     if not c:
       return None
     elif c == '(' or c == ')':
@@ -268,6 +331,10 @@ class Lexer:
     elif c in string.whitespace:
       self.skipws()
       return self.token()
+    else:
+      # Skip it, or reading would stop here as if at the end of input
+      r.nxt()
+      raise LexerException, "unexpected character '%s'" % (c,)
   def tokens(self):
     while True:
       tok = self.token()
@@ -293,7 +360,8 @@ class Lexer:
       'f': '\f'
     }
     r = self.rdr
-    s = ''
+    s = []
+    bad = None
     while r.peek() != '"':
       if not r.peek():
         raise LexerException, "unexpected EOF"
@@ -301,31 +369,37 @@ class Lexer:
         # Escape code \n \r \f etc
         r.nxt()
         if r.peek() not in esc:
-          raise LexerException, "unknown escape code '%s' in string" % (r.peek(),)
+          # Read on to the closing quote so the next token is after the string
+          bad = bad or r.peek()
+          if r.peek():
+            r.nxt()
+          continue
         else:
-          s += esc[r.peek()]
+          s.append(esc[r.peek()])
           r.nxt()
           continue
-      s += r.peek()
+      s.append(r.peek())
       r.nxt()
     r.nxt()
-    return s
+    if bad is not None:
+      raise LexerException, "unknown escape code '%s' in string" % (bad,)
+    return ''.join(s)
   def readnum(self):
     r = self.rdr
-    i = ''
+    i = []
     while r.peek() and r.peek() in string.digits:
-      i += r.peek()
+      i.append(r.peek())
       r.nxt()
-    return int(i)
+    return int(''.join(i))
   def readsym(self):
     r = self.rdr
     c = string.ascii_letters + string.digits + '+-*/<=>!?:$%_&~^'
-    s = r.peek()
+    s = [r.peek()]
     r.nxt()
     while r.peek() and r.peek() in c:
-      s += r.peek()
+      s.append(r.peek())
       r.nxt()
-    return s
+    return ''.join(s)
   def readbool(self):
     r = self.rdr
     c = r.peek()
@@ -344,8 +418,26 @@ class ParserException(Exception):
 class Parser:
   def __init__(self, lex):
     self.lexer = lex
+    # Open parens of the form being read
+    self.depth = 0
+    # Line and column where the last top level form started
+    self.start = (1, 1)
   def error(self, s):
     raise ParserException, s
+  def recover(self):
+    """Skips the rest of a form after an error, up to its closing paren."""
+    while self.depth > 0:
+      try:
+        t = self.lexer.get()
+      except LexerException:
+        continue
+      if t is None:
+        break
+      elif t == '(':
+        self.depth += 1
+      elif t == ')':
+        self.depth -= 1
+    self.depth = 0
   def atomp(self, t):
     return self.oneof(t, [String, Boolean, Symbol, Number])
   def oneof(self, tok, ts):
@@ -358,11 +450,14 @@ class Parser:
     #      | pair
     #      | '\'' sexp
     t = self.lexer.get()
+    if self.depth == 0:
+      self.start = self.lexer.where
     if t is None:
       return t
     if self.atomp(t):
       return t
     elif t == '(':
+      self.depth += 1
       return self.pair(True)
     elif t == '\'':
       s = self.sexp()
@@ -382,7 +477,10 @@ class Parser:
     # pair : '(' sexp* ')'
     #      | '(' sexp+ . sexp ')'
     t = self.lexer.get()
-    if t == ')':
+    if t is None:
+      self.error("unexpected EOF, expected token ')'")
+    elif t == ')':
+      self.depth -= 1
       return Null
     elif t == '\'' or t == '`' or t == ',' or t == ',@':
       self.lexer.unget(t)
@@ -397,8 +495,10 @@ class Parser:
       t = self.lexer.get()
       if t != ')':
         self.error("expected token ')', got '%s'" % t)
+      self.depth -= 1
       return s
     else:
+      self.depth += 1
       fst = self.pair(True)
       snd = self.pair()
       return Pair(fst, snd)
@@ -407,9 +507,11 @@ class KuaoException(Exception):
   pass
 
 class Env:
-  def __init__(self, parent=None):
+  def __init__(self, parent=None, scope=None):
     self.parent = parent
     self.bindings = {}
+    # Scope of the lambda whose call made this frame, None if not known
+    self.scope = scope
   def find_binding(self, key):
     if self.bindings.has_key(key):
       return self.bindings
@@ -446,6 +548,25 @@ class Env:
     if self.parent:
       self.parent.printe(indent+2)
 
+class Captured(Env):
+  """
+  Environment of a flat closure. Holds copies of the free variables that can
+  never change, and for the others the binding dicts of the frames where they
+  are or may yet be defined, innermost first. Everything else is looked up in
+  toplevel, so the closure keeps no other frames alive.
+  """
+  def __init__(self, bindings, frames):
+    Env.__init__(self, toplevel)
+    self.bindings = bindings
+    self.frames = frames
+  def find_binding(self, key):
+    if key in self.bindings:
+      return self.bindings
+    for frame in self.frames.get(key, ()):
+      if key in frame:
+        return frame
+    return self.parent.find_binding(key)
+
 def error(s):
   raise KuaoException, 'error: %s' % s
 
@@ -458,6 +579,19 @@ def checktype(scope, exp, typ):
   if not isinstance(exp, typ):
     error("argument to '%s' must be of type '%s'" % (scope, typ))
 
+def checkrange(name, exp, least, most):
+  length = exp.length()
+  if length < least or length > most:
+    error("'%s' requires %d to %d args, got %d" % (name, least, most, length))
+  return length
+
+def makelist(xs):
+  """Builds a proper list out of a Python sequence."""
+  ret = Null
+  for x in reversed(xs):
+    ret = Pair(x, ret)
+  return ret
+
 toplevel = Env()
 
 def special(name):
@@ -499,6 +633,7 @@ def definemacro(env, exp):
   body = exp.cdr.car
   mac = Macro(sym.car, sym.cdr, body, env)
   env.define(sym.car, mac)
+  macros.add(sym.car)
   return Undef
 
 @special('define')
@@ -620,37 +755,230 @@ def runif(env, exp):
   true = exp.cdr.car
   false = exp.cdr.cdr
   e = tramp(keval(env, cond))
+  # Branches are in tail position, leave them for the caller's tramp
   if isinstance(e, Boolean) and e.value:
-    return tramp(keval(env, true))
+    return keval(env, true)
   elif isinstance(e, Boolean) and not e.value:
     if false is Null:
       return Undef
     else:
-      return tramp(keval(env, false.car))
+      return keval(env, false.car)
   else:
-    return tramp(keval(env, true))
+    return keval(env, true)
+
+# Whether closures capture only their free variables rather than the whole
+# environment they were made in
+flatclosures = True
+
+# Names ever given to a macro. Macros aren't hygienic, what their expansion
+# refers to, sets or defines can't be seen from the text of a lambda
+macros = set()
+
+class Scope(object):
+  """
+  What a lambda expression does with variables, as far as can be seen from
+  its text. Every symbol outside a quote counts as a possible reference, so
+  free over-approximates the free variables, which is always safe. That is
+  unless a macro is used, see expands.
+
+  The lambda expressions written in the body are kept here too, keyed like
+  scopeof does, so that their own Scope is only worked out once and lives
+  exactly as long as the code it describes.
+  """
+  def __init__(self, params, body):
+    self.body = Pair(Symbol('begin'), body)
+    self.params = set()
+    while isinstance(params, Pair):
+      self.params.add(params.car)
+      params = params.cdr
+    if isinstance(params, Symbol):
+      self.params.add(params)
+    # Targets of set! and define anywhere in the body. Setting a variable that
+    # isn't bound anywhere binds it in the frame, so both may add to a frame
+    self.assigned = set()
+    self.defined = set()
+    # Symbols at the head of a form, to spot macros that rewrite variables
+    self.heads = set()
+    self.free = set()
+    # Nested lambda expressions, their Scope once one was needed
+    self.lambdas = {}
+    # What capture does for each chain of frames it meets, see plan
+    self.plans = {}
+    self.scan(body)
+    self.free -= self.params
+  def scan(self, e):
+    stack = [e]
+    while stack:
+      e = stack.pop()
+      if isinstance(e, Symbol):
+        self.free.add(e)
+      elif isinstance(e, Pair):
+        head = e.car
+        # A signature or parameter list, not a call, so its head isn't either
+        skip = None
+        if isinstance(head, Symbol):
+          if head.value == 'quote':
+            continue
+          self.heads.add(head)
+          target = e.cdr.car if isinstance(e.cdr, Pair) else None
+          if head.value == 'set!' and isinstance(target, Symbol):
+            self.assigned.add(target)
+          elif head.value == 'define':
+            if isinstance(target, Pair):
+              # The lambda define makes of (define (name . params) . body)
+              self.lambdas[(target.cdr, e.cdr.cdr)] = None
+              skip = target
+              target = target.car
+            if isinstance(target, Symbol):
+              self.defined.add(target)
+          elif head.value == 'define-macro':
+            if isinstance(target, Pair) and isinstance(target.car, Symbol):
+              self.defined.add(target.car)
+              skip = target
+          elif head.value == 'lambda' and isinstance(e.cdr, Pair):
+            self.lambdas[(e.cdr.car, e.cdr.cdr)] = None
+            skip = target
+        # Walk the spine here, only nested lists go on the stack
+        while isinstance(e, Pair):
+          if e.car is not skip:
+            stack.append(e.car)
+          e = e.cdr
+        stack.append(e)
+  def expands(self):
+    """Whether the body uses a macro, which may do anything with variables."""
+    return not self.heads.isdisjoint(macros)
+  def child(self, key):
+    """The Scope of a lambda written in the body, None for any other."""
+    if key not in self.lambdas:
+      return None
+    scope = self.lambdas[key]
+    if scope is None:
+      scope = self.lambdas[key] = Scope(*key)
+    return scope
+  def plan(self, scopes):
+    """
+    How capture deals with each free variable in frames of the given scopes,
+    innermost first. What a frame of a known lambda can bind follows from its
+    text, so this is the same for every closure made in such a chain:
+
+      copies  (sym, i), the value in frame i never changes and is copied
+      shares  (sym, frames), the frames it may be bound in, the last binds it
+      rest    [sym, frames, unsure], not bound in the chain but maybe in the
+              frames listed, for the rest it's up to what's further out.
+              unsure while sym is called but not defined at toplevel yet
+
+    Frames of unknown lambdas, or of lambdas using macros, may bind anything
+    and are shared for every variable. Plans change when macros are defined.
+    """
+    got = self.plans.get(scopes)
+    if got is not None and got[0] == len(macros):
+      return got[1]
+    copies, shares, rest = [], [], []
+    for sym in self.free:
+      found = []
+      for i, s in enumerate(scopes):
+        if s is None or s.expands():
+          found.append(i)
+        elif sym in s.params:
+          if not found and sym not in s.assigned and sym not in s.defined:
+            copies.append((sym, i))
+          else:
+            found.append(i)
+            shares.append((sym, tuple(found)))
+          break
+        elif sym in s.defined or sym in s.assigned:
+          found.append(i)
+      else:
+        rest.append([sym, tuple(found), sym in self.heads])
+    plan = (copies, shares, rest)
+    self.plans[scopes] = (len(macros), plan)
+    return plan
+
+def scopeof(env, exp):
+  """
+  The Scope of the lambda expression exp evaluated in env. One written in the
+  body of another lambda is found in the Scope of the nearest frame that has
+  one. Lambdas at toplevel run once, and are worked out afresh. Any other was
+  made up by a macro, gets None and its closures keep their whole environment.
+  """
+  e = env
+  while e is not None and e is not toplevel:
+    if e.scope is not None:
+      return e.scope.child((exp.car, exp.cdr))
+    e = e.parent
+  return Scope(exp.car, exp.cdr)
+
+def capture(env, scope):
+  """
+  The environment for a closure of scope made in env. Variables that can't
+  change are copied; for the others, every frame up to the one that binds them
+  is kept when it may come to define them later, which is when its lambda has
+  a matching define, or when what its lambda does is unknown. A body that uses
+  a macro, or calls something not defined yet, keeps the whole of env.
+  """
+  if env is toplevel or scope.expands():
+    return env
+  # The frames up to toplevel or the environment of an enclosing flat closure
+  chain = []
+  e = env
+  while e is not toplevel and not isinstance(e, Captured):
+    chain.append(e)
+    e = e.parent
+  outer = e if e is not toplevel else None
+  copies, shares, rest = scope.plan(tuple([f.scope for f in chain]))
+  bindings = {}
+  frames = {}
+  for sym, i in copies:
+    bindings[sym] = chain[i].bindings[sym]
+  for sym, found in shares:
+    frames[sym] = tuple([chain[i].bindings for i in found])
+  for entry in rest:
+    sym, found, unsure = entry
+    found = [chain[i].bindings for i in found]
+    if outer is not None:
+      if sym in outer.bindings:
+        if not found:
+          bindings[sym] = outer.bindings[sym]
+          continue
+        found.append(outer.bindings)
+      else:
+        found.extend(outer.frames.get(sym, ()))
+    if found:
+      frames[sym] = tuple(found)
+    elif unsure:
+      if sym not in toplevel.bindings:
+        # Not defined yet, it could still turn out to be a macro
+        return env
+      # Toplevel bindings are never taken away, no need to look again
+      entry[2] = False
+  return Captured(bindings, frames)
 
 @special('lambda')
 def mklambda(env, exp):
   if exp is Null or exp.cdr is Null:
     error("lambda requires 2 arguments")
   args = exp.car
-  body = Pair(Symbol('begin'), exp.cdr)
-  return Closure(env, args, body)
+  scope = scopeof(env, exp) if flatclosures else None
+  if scope is None:
+    return Closure(env, args, Pair(Symbol('begin'), exp.cdr))
+  return Closure(capture(env, scope), args, scope.body, scope)
 
 @special('begin')
 def begin(env, exp):
   ret = Undef
-  for form in exp.each():
-    ret = keval(env, form)
-    ret = tramp(ret)
+  while exp is not Null:
+    if exp.cdr is Null:
+      # Last form is in tail position, leave it for the caller's tramp
+      return keval(env, exp.car)
+    tramp(keval(env, exp.car))
+    exp = exp.cdr
   return ret
 
 @special('and')
 def kand(env, exp):
   ret = T
   for e in exp.each():
-    ev = e.eval(env)
+    ev = kevalt(env, e)
     if ev is F:
       return F
     ret = ev
@@ -660,19 +988,259 @@ def kand(env, exp):
 def kor(env, exp):
   ret = F
   for e in exp.each():
-    ev = e.eval(env)
+    ev = kevalt(env, e)
     if ev is not F:
       return ev
     ret = ev
   return ret
 
+def displayed(val):
+  """The text display prints for val."""
+  if isinstance(val, String):
+    return val.value
+  elif isinstance(val, StringBuilder):
+    return val.getvalue()
+  else:
+    return str(val)
+
+class OutputPort:
+  """
+  Buffered output to a file. Writes are collected in a list and only handed
+  to the file once BUFSIZE characters have piled up, or on flush.
+  """
+  BUFSIZE = 1 << 16
+  def __init__(self, f, name):
+    self.file = f
+    self.name = name
+    self.parts = []
+    self.size = 0
+  def write(self, s):
+    self.parts.append(s)
+    self.size += len(s)
+    if self.size >= self.BUFSIZE:
+      self.drain()
+  def writelines(self, parts):
+    for s in parts:
+      self.write(s)
+  def drain(self):
+    if self.parts:
+      self.file.write(''.join(self.parts))
+      self.parts = []
+      self.size = 0
+  def flush(self):
+    self.drain()
+    self.file.flush()
+  def close(self):
+    self.drain()
+    self.file.close()
+  def __str__(self):
+    return '#(output-port %s)' % self.name
+
+# Where display and newline write when not given a port
+output = OutputPort(sys.stdout, '<stdout>')
+
+def portarg(name, exp):
+  """The optional port argument in exp, or the current output port."""
+  if exp is Null:
+    return output
+  port = exp.car
+  if not isinstance(port, (OutputPort, StringBuilder)):
+    error("port argument to '%s' must be an output port or string builder" % name)
+  return port
+
 @primitive('display')
 def display(env, exp):
+  checkrange('display', exp, 1, 2)
   val = exp.car
-  pr = val.value if isinstance(val, String) else str(val)
-  sys.stdout.write(pr)
+  port = portarg('display', exp.cdr)
+  if isinstance(val, StringBuilder):
+    # Write the fragments out as they are, no need to join them first
+    port.writelines(val.parts)
+  elif isinstance(val, Pair):
+    val.write(port)
+  else:
+    port.write(displayed(val))
+  return Undef
+
+@primitive('newline')
+def newline(env, exp):
+  checkrange('newline', exp, 0, 1)
+  portarg('newline', exp).write('\n')
+  return Undef
+
+@primitive('flush-output')
+def flushoutput(env, exp):
+  checkrange('flush-output', exp, 0, 1)
+  portarg('flush-output', exp).flush()
+  return Undef
+
+@primitive('current-output-port')
+def currentoutputport(env, exp):
+  check('current-output-port', exp, 0)
+  return output
+
+def withoutput(port, thunk, env):
+  """Calls thunk with port as the current output port."""
+  global output
+  saved = output
+  output = port
+  try:
+    if isinstance(thunk, Closure):
+      return applyclosure(thunk, Null)
+    return tramp(thunk(env, Null))
+  finally:
+    output = saved
+
+@primitive('with-output-to-file')
+def withoutputtofile(env, exp):
+  check('with-output-to-file', exp, 2)
+  filename = exp.car
+  checktype('with-output-to-file', filename, String)
+  thunk = exp.cdr.car
+  checktype('with-output-to-file', thunk, (Closure, Primitive))
+  try:
+    port = OutputPort(open(filename.value, 'w'), filename.value)
+  except IOError as e:
+    error("cannot open '%s': %s" % (filename.value, e.strerror))
+  try:
+    return withoutput(port, thunk, env)
+  finally:
+    port.close()
+
+@primitive('with-output-to-string')
+def withoutputtostring(env, exp):
+  check('with-output-to-string', exp, 1)
+  thunk = exp.car
+  checktype('with-output-to-string', thunk, (Closure, Primitive))
+  sb = StringBuilder()
+  withoutput(sb, thunk, env)
+  return String(sb.getvalue())
+
+class StringBuilder:
+  """
+  Mutable string kept as a list of fragments that are only joined when the
+  whole string is needed, so appending is amortized O(1).
+  """
+  def __init__(self):
+    self.parts = []
+    self.size = 0
+  def write(self, s):
+    self.parts.append(s)
+    self.size += len(s)
+  def writelines(self, parts):
+    # Copy first, parts may be our own when a builder is displayed to itself
+    parts = list(parts)
+    self.parts.extend(parts)
+    self.size += sum(len(s) for s in parts)
+  def flush(self):
+    pass
+  def getvalue(self):
+    if len(self.parts) > 1:
+      self.parts = [''.join(self.parts)]
+    return self.parts[0] if self.parts else ''
+  def __str__(self):
+    return '#(string-builder %d)' % self.size
+
+@primitive('make-string-builder')
+def makestringbuilder(env, exp):
+  check('make-string-builder', exp, 0)
+  return StringBuilder()
+
+@primitive('string-builder-append!')
+def stringbuilderappend(env, exp):
+  if exp is Null:
+    error("'string-builder-append!' requires at least 1 argument")
+  sb = exp.car
+  checktype('string-builder-append!', sb, StringBuilder)
+  for val in exp.cdr.each():
+    sb.write(displayed(val))
   return Undef
 
+@primitive('string-builder->string')
+def stringbuildertostring(env, exp):
+  check('string-builder->string', exp, 1)
+  sb = exp.car
+  checktype('string-builder->string', sb, StringBuilder)
+  return String(sb.getvalue())
+
+@primitive('string-builder-length')
+def stringbuilderlength(env, exp):
+  check('string-builder-length', exp, 1)
+  sb = exp.car
+  checktype('string-builder-length', sb, StringBuilder)
+  return Number(sb.size)
+
+@primitive('string?')
+def kstringp(env, exp):
+  check('string?', exp, 1)
+  return T if isinstance(exp.car, String) else F
+
+@primitive('string-append')
+def stringappend(env, exp):
+  parts = []
+  for s in exp.each():
+    checktype('string-append', s, String)
+    parts.append(s.value)
+  return String(''.join(parts))
+
+@primitive('string-length')
+def stringlength(env, exp):
+  check('string-length', exp, 1)
+  s = exp.car
+  checktype('string-length', s, String)
+  return Number(len(s.value))
+
+@primitive('substring')
+def substring(env, exp):
+  length = checkrange('substring', exp, 2, 3)
+  s = exp.car
+  checktype('substring', s, String)
+  start = exp.cdr.car
+  checktype('substring', start, Number)
+  end = exp.cdr.cdr.car if length == 3 else Number(len(s.value))
+  checktype('substring', end, Number)
+  if not 0 <= start.value <= end.value <= len(s.value):
+    error("indices %s and %s out of range for 'substring' of length %d"
+          % (start, end, len(s.value)))
+  return String(s.value[start.value:end.value])
+
+@primitive('string-split')
+def stringsplit(env, exp):
+  length = checkrange('string-split', exp, 1, 2)
+  s = exp.car
+  checktype('string-split', s, String)
+  if length == 1:
+    # Runs of whitespace, like str.split()
+    parts = s.value.split()
+  else:
+    sep = exp.cdr.car
+    checktype('string-split', sep, String)
+    if not sep.value:
+      error("separator for 'string-split' must not be empty")
+    parts = s.value.split(sep.value)
+  return makelist([String(p) for p in parts])
+
+@primitive('string->symbol')
+def stringtosymbol(env, exp):
+  check('string->symbol', exp, 1)
+  s = exp.car
+  checktype('string->symbol', s, String)
+  return Symbol(s.value)
+
+@primitive('symbol->string')
+def symboltostring(env, exp):
+  check('symbol->string', exp, 1)
+  sym = exp.car
+  checktype('symbol->string', sym, Symbol)
+  return String(sym.value)
+
+@primitive('number->string')
+def numbertostring(env, exp):
+  check('number->string', exp, 1)
+  n = exp.car
+  checktype('number->string', n, Number)
+  return String(str(n.value))
+
 @primitive('+')
 def plus(env, exp):
   n = Number(0)
@@ -775,6 +1343,8 @@ def kapply(env, exp):
     error("'apply' requires 2 arguments, given %d" % length)
   fn = exp.car
   lst = exp.cdr.car
+  if isinstance(fn, Closure):
+    return Recurse(keval, bindargs(fn, 'closure', lst), fn.body)
   return fn(env, lst)
 
 @primitive('pair?')
@@ -804,6 +1374,119 @@ def eqvp(env, exp):
     else:
       return T if arg1 is arg2 else F
 
+def equalkey(e):
+  """
+  A hashable stand-in for e such that two values have equal keys exactly when
+  they are equal?. Symbols, numbers and other atoms are their own key, as
+  they already compare like eqv?.
+  """
+  if isinstance(e, Pair):
+    # Walk the spine in a loop, lists can be much longer than the stack
+    key = []
+    while isinstance(e, Pair):
+      key.append(equalkey(e.car))
+      e = e.cdr
+    key.append(equalkey(e))
+    return (Pair,) + tuple(key)
+  elif isinstance(e, String):
+    return (String, e.value)
+  else:
+    return e
+
+@primitive('equal?')
+def equalp(env, exp):
+  check('equal?', exp, 2)
+  return T if equalkey(exp.car) == equalkey(exp.cdr.car) else F
+
+class HashTable:
+  """
+  Mutable table backed by a dict. Keys are compared with eqv? or with equal?,
+  in which case the dict is keyed by equalkey and keeps the original key next
+  to the value.
+  """
+  def __init__(self, equal=True):
+    self.equal = equal
+    self.table = {}
+  def key(self, k):
+    return equalkey(k) if self.equal else k
+  def get(self, k, default=None):
+    entry = self.table.get(self.key(k))
+    return default if entry is None else entry[1]
+  def set(self, k, v):
+    self.table[self.key(k)] = (k, v)
+  def remove(self, k):
+    self.table.pop(self.key(k), None)
+  def keys(self):
+    ret = Null
+    for k, v in self.table.itervalues():
+      ret = Pair(k, ret)
+    return ret
+  def __len__(self):
+    return len(self.table)
+  def __str__(self):
+    return '#(hash-table %d)' % len(self.table)
+
+@primitive('make-hash-table')
+def makehashtable(env, exp):
+  length = exp.length()
+  if length > 1:
+    error("'make-hash-table' requires 0 or 1 arguments, given %d" % length)
+  if exp is Null:
+    return HashTable()
+  test = exp.car
+  if not isinstance(test, Primitive) or test.fn not in (eqvp, equalp):
+    error("argument to 'make-hash-table' must be eqv? or equal?")
+  return HashTable(test.fn is equalp)
+
+@primitive('hash-table?')
+def hashtablep(env, exp):
+  check('hash-table?', exp, 1)
+  return T if isinstance(exp.car, HashTable) else F
+
+@primitive('hash-ref')
+def hashref(env, exp):
+  length = checkrange('hash-ref', exp, 2, 3)
+  table = exp.car
+  checktype('hash-ref', table, HashTable)
+  key = exp.cdr.car
+  value = table.get(key)
+  if value is not None:
+    return value
+  elif length == 3:
+    return exp.cdr.cdr.car
+  else:
+    error("no value for key '%s' in hash table" % key)
+
+@primitive('hash-set!')
+def hashset(env, exp):
+  check('hash-set!', exp, 3)
+  table = exp.car
+  checktype('hash-set!', table, HashTable)
+  table.set(exp.cdr.car, exp.cdr.cdr.car)
+  return Undef
+
+@primitive('hash-remove!')
+def hashremove(env, exp):
+  check('hash-remove!', exp, 2)
+  table = exp.car
+  checktype('hash-remove!', table, HashTable)
+  table.remove(exp.cdr.car)
+  return Undef
+
+@primitive('hash-count')
+def hashcount(env, exp):
+  check('hash-count', exp, 1)
+  table = exp.car
+  checktype('hash-count', table, HashTable)
+  return Number(len(table))
+
+@primitive('hash-keys')
+def hashkeys(env, exp):
+  check('hash-keys', exp, 1)
+  table = exp.car
+  checktype('hash-keys', table, HashTable)
+  return table.keys()
+
 def ziptoenv(pars, args, env):
   env.define(pars.car, args.car)
   if isinstance(pars.cdr, Symbol):
@@ -822,6 +1505,8 @@ def kevalt(env, exp):
 def kevalpair(env, exp):
   if exp is Null:
     return Null
+  elif type(exp) is not Pair:
+    error('cannot evaluate improper list application')
   else:
     # Tramp on the eval since argument to fn could be trampoline
     ecar = kevalt(env, exp.car)
@@ -843,7 +1528,11 @@ def mapargstoparams(fun, typ, env, exp):
   args are eval'd.
   """
   args = kevalpair(env, exp.cdr) if typ == 'closure' else exp.cdr
-  nenv = Env(fun.env)
+  return bindargs(fun, typ, args)
+
+def bindargs(fun, typ, args):
+  """Returns a new environment for fun with args mapped to its params."""
+  nenv = Env(fun.env, fun.scope if typ == 'closure' else None)
   if isinstance(fun.params, Symbol):
     # (lambda args ...)
     nenv.define(fun.params, args)
@@ -858,14 +1547,76 @@ def mapargstoparams(fun, typ, env, exp):
     error('%s params must be a symbol or list' % typ)
   return nenv
 
+def applyclosure(fn, args):
+  return tramp(keval(bindargs(fn, 'closure', args), fn.body))
+
+class Memoized(Primitive):
+  """
+  A function wrapped with a cache of its results, keyed by the equalkey of its
+  arguments. When the cache holds size entries, the least recently used one
+  is dropped to make room.
+  """
+  def __init__(self, fn, size=None):
+    self.fn = fn
+    self.name = fn.name
+    self.size = size
+    self.cache = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+  def __str__(self):
+    return '#(memoized %s)' % self.fn
+  def __call__(self, env, args):
+    checkproper(args)
+    key = equalkey(args)
+    cache = self.cache
+    if key in cache:
+      self.hits += 1
+      # Move to the most recently used end
+      ret = cache[key] = cache.pop(key)
+      return ret
+    self.misses += 1
+    fn = self.fn
+    if isinstance(fn, Closure):
+      ret = applyclosure(fn, args)
+    else:
+      ret = tramp(fn(env, args))
+    cache[key] = ret
+    if self.size is not None and len(cache) > self.size:
+      cache.popitem(False)
+    return ret
+
+@primitive('memoize')
+def memoize(env, exp):
+  length = checkrange('memoize', exp, 1, 2)
+  fn = exp.car
+  if not isinstance(fn, (Closure, Primitive)):
+    error("argument to 'memoize' must be a function")
+  if length == 1:
+    return Memoized(fn)
+  size = exp.cdr.car
+  if not isinstance(size, Number) or size.value < 1:
+    error("max entries for 'memoize' must be a positive number")
+  return Memoized(fn, size.value)
+
+@primitive('memoize-stats')
+def memoizestats(env, exp):
+  check('memoize-stats', exp, 1)
+  fn = exp.car
+  checktype('memoize-stats', fn, Memoized)
+  stats = [('hits', fn.hits), ('misses', fn.misses), ('entries', len(fn.cache))]
+  return makelist([Pair(Symbol(name), Number(value)) for name, value in stats])
+
 def keval(env, exp):
-  if isinstance(exp, (Number, String, Boolean)):
-    return exp
-  elif isinstance(exp, Symbol):
+  # Exact type tests, a failing isinstance on a new-style class is slow and
+  # this is the hottest function there is
+  typ = type(exp)
+  if typ is Symbol:
     return env.lookup(exp)
-  elif isinstance(exp, Pair):
-    if not exp.proper:
-      error('cannot evaluate improper list application')
+  elif typ is Number or typ is String or typ is Boolean:
+    return exp
+  elif typ is Pair:
+    # Properness is checked on the way: kevalpair stops at an improper tail
+    # and specials check their arguments
     fn = tramp(keval(env, exp.car))
     if isinstance(fn, Primitive):
       args = kevalpair(env, exp.cdr)
@@ -877,6 +1628,8 @@ def keval(env, exp):
       nenv = mapargstoparams(fn, 'closure', env, exp)
       return Recurse(keval, nenv, fn.body)
     elif isinstance(fn, Macro):
+      if not exp.proper:
+        error('cannot evaluate improper list application')
       nenv = mapargstoparams(fn, 'macro', env, exp)
       body = fn.body
       if body.car == Symbol('quasiquote'):
@@ -891,34 +1644,463 @@ def keval(env, exp):
   elif isinstance(exp, NullType):
     error('cannot evaluate empty procedure application')
 
-def repl(strm, interactive=True):
+class LimitExceeded(KuaoException):
+  """Raised when evaluation runs past one of the budgets of a Limits."""
+  def __init__(self, what, limit, limits):
+    self.what = what
+    self.limit = limit
+    self.steps = limits.steps
+    self.pairs = limits.pairs
+    self.stringbytes = limits.stringbytes
+    self.elapsed = limits.elapsed()
+    KuaoException.__init__(self,
+        'error: %s limit of %s exceeded '
+        '(used %d steps, %d pairs, %d string bytes, %.3fs)'
+        % (what, limit, self.steps, self.pairs, self.stringbytes,
+           self.elapsed))
+
+class Limits:
+  """
+  Budgets on evaluation steps, allocated pairs, string bytes and wall time,
+  counted while the Limits is used as a context manager.
+
+  Entering swaps the module level keval, Pair.__init__, String.__init__ and
+  the writing methods of StringBuilder for metered versions, and leaving puts
+  the originals back, so evaluation without limits pays nothing for the
+  accounting. A step is one call to keval, which includes every bounce of a
+  trampolined tail call. Every string made and everything written to a string
+  builder counts against the string bytes, since neither is bounded by steps.
+  """
+  # Reading the clock is slow compared to a step, so only do it this often
+  CLOCK_INTERVAL = 1024
+  def __init__(self, steps=None, pairs=None, seconds=None, stringbytes=None):
+    self.maxsteps = steps
+    self.maxpairs = pairs
+    self.maxseconds = seconds
+    self.maxstringbytes = stringbytes
+    self.steps = 0
+    self.pairs = 0
+    self.stringbytes = 0
+    self.started = None
+    self.saved = None
+  def elapsed(self):
+    if self.started is None:
+      return 0.0
+    return time.time() - self.started
+  def metered(self, keval):
+    maxsteps = self.maxsteps
+    maxseconds = self.maxseconds
+    deadline = self.started + maxseconds if maxseconds is not None else None
+    interval = self.CLOCK_INTERVAL
+    def stepped(env, exp):
+      self.steps += 1
+      steps = self.steps
+      if maxsteps is not None and steps > maxsteps:
+        raise LimitExceeded('step', maxsteps, self)
+      if deadline is not None and steps % interval == 0 and time.time() > deadline:
+        raise LimitExceeded('time', '%gs' % maxseconds, self)
+      return keval(env, exp)
+    return stepped
+  def counted(self, init):
+    maxpairs = self.maxpairs
+    def allocate(pair, car, cdr):
+      self.pairs += 1
+      if maxpairs is not None and self.pairs > maxpairs:
+        raise LimitExceeded('pair', maxpairs, self)
+      init(pair, car, cdr)
+    return allocate
+  def charge(self, n):
+    self.stringbytes += n
+    limit = self.maxstringbytes
+    if limit is not None and self.stringbytes > limit:
+      raise LimitExceeded('string byte', limit, self)
+  def sized(self, init):
+    def allocate(s, value):
+      self.charge(len(value))
+      init(s, value)
+    return allocate
+  def written(self, write, writelines):
+    def chargedwrite(sb, s):
+      self.charge(len(s))
+      write(sb, s)
+    def chargedwritelines(sb, parts):
+      parts = list(parts)
+      self.charge(sum(len(s) for s in parts))
+      writelines(sb, parts)
+    return chargedwrite, chargedwritelines
+  def __enter__(self):
+    global keval
+    self.started = time.time()
+    self.saved = (keval, Pair.__dict__['__init__'], String.__dict__['__init__'],
+                  StringBuilder.__dict__['write'],
+                  StringBuilder.__dict__['writelines'])
+    keval = self.metered(keval)
+    Pair.__init__ = self.counted(self.saved[1])
+    String.__init__ = self.sized(self.saved[2])
+    writes = self.written(*self.saved[3:])
+    StringBuilder.write, StringBuilder.writelines = writes
+    return self
+  def __exit__(self, *exc):
+    global keval
+    (keval, Pair.__init__, String.__init__,
+     StringBuilder.write, StringBuilder.writelines) = self.saved
+    self.saved = None
+    return False
+
+def repl(strm):
   p = Parser(Lexer(strm))
   while True:
-    # Can't use print with ,: it forces leading space next print
-    if interactive:
-      sys.stdout.write('kuao> ')
+    output.write('kuao> ')
+    output.flush()
     try:
       sexp = p.sexp()
       if sexp is None:
         break
       ret = tramp(keval(toplevel, sexp))
-      if ret is not Undef and interactive:
-        print ret
-    except ParserException as e:
-      print e
-      sys.exit()
+      if ret is not Undef:
+        writeobj(ret, output)
+        output.write('\n')
+    except LimitExceeded:
+      # The budget is spent, every later form would fail straight away
+      raise
+    except (ParserException, LexerException) as e:
+      output.write('%s\n' % e)
+      p.recover()
     except KuaoException as e:
-      if interactive:
-        print e
-      else:
-        raise e
+      output.write('%s\n' % e)
+
+def report(name, where, e):
+  # Keep the error in order with the output before it
+  output.flush()
+  sys.stderr.write('%s:%d:%d: %s\n' % (name, where[0], where[1], e))
+
+def run(strm, name='<stdin>', keepgoing=False, encoder=None):
+  """
+  Evaluates the forms of a script or pipe one by one, each as soon as it has
+  been read. Errors are reported on stderr with the position of the failing
+  form and stop the run, unless keepgoing is set, in which case the next form
+  is evaluated instead. Exceeding a Limits always stops the run. Forms read
+  are also given to encoder, if there is one, for the parse cache.
+
+  Returns the number of errors.
+  """
+  lexer = Lexer(strm)
+  p = Parser(lexer)
+  errors = 0
+  while True:
+    try:
+      sexp = p.sexp()
+      if sexp is None:
+        if encoder is not None:
+          encoder.done()
+        break
+      if encoder is not None:
+        encoder.add(sexp, p.start)
+      tramp(keval(toplevel, sexp))
+      continue
+    except LimitExceeded:
+      raise
+    except (ParserException, LexerException) as e:
+      if encoder is not None:
+        encoder.fail()
+      report(name, lexer.where, e)
+      p.recover()
+    except KuaoException as e:
+      report(name, p.start, e)
+    except Exception as e:
+      # A primitive given the wrong kind of argument fails inside Python
+      report(name, p.start, '%s: %s' % (e.__class__.__name__, e))
+    errors += 1
+    if not keepgoing:
+      break
+  output.flush()
+  return errors
+
+def runforms(forms, name='<stdin>', keepgoing=False):
+  """Like run, for forms already read, each with the position it started at."""
+  errors = 0
+  for sexp, start in forms:
+    try:
+      tramp(keval(toplevel, sexp))
+      continue
+    except LimitExceeded:
+      raise
+    except KuaoException as e:
+      report(name, start, e)
+    except Exception as e:
+      report(name, start, '%s: %s' % (e.__class__.__name__, e))
+    errors += 1
+    if not keepgoing:
+      break
+  output.flush()
+  return errors
+
+# Parse cache. Scripts are stored already read, in the spirit of .pyc files,
+# as a marshalled tuple of an interned symbol table, a table of string and
+# number constants, the forms as one array of tagged nodes and the position
+# of each form. Only the read forms are kept: what macros expand to depends
+# on the definitions in force when the form runs.
+
+CACHEFORMAT = 1
+CACHEDIR = '__kuaocache__'
+
+# Scripts bigger than this are only ever streamed, a cache is read whole
+CACHEMAX = 8 << 20
+
+# Node tags. LIST is followed by its length, its elements and its tail,
+# SYMBOL, STRING and NUMBER by an index into their table.
+NULL, TRUE, FALSE, SYMBOL, STRING, NUMBER, LIST = range(7)
+
+# Where the cache goes, None to always read scripts from source
+cachedir = CACHEDIR
+
+def interpreterhash():
+  """Digest of this file, so a changed reader or printer drops old caches."""
+  path = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+  try:
+    return hashlib.sha1(open(path, 'rb').read()).hexdigest()
+  except IOError:
+    return ''
+
+cachesalt = None
+
+def newkey():
+  """A digest to feed a script's source to, to get its cache key."""
+  global cachesalt
+  if cachesalt is None:
+    # The code array is stored in the machine's own int layout
+    cachesalt = '%d:%s:%s:%d:%s:' % (CACHEFORMAT, sys.version, sys.byteorder,
+                                     array.array('i').itemsize,
+                                     interpreterhash())
+  return hashlib.sha1(cachesalt)
+
+def cachekey(strm):
+  key = newkey()
+  while True:
+    chunk = strm.read(Reader.CHUNK)
+    if not chunk:
+      return key.hexdigest()
+    key.update(chunk)
+
+class Hashed:
+  """A stream that feeds everything read from it to a cache key."""
+  def __init__(self, strm):
+    self.stream = strm
+    self.key = newkey()
+  def readline(self, size=-1):
+    line = self.stream.readline(size)
+    self.key.update(line)
+    return line
+
+def cachepath(path):
+  base = os.path.basename(path) + '.kc'
+  if cachedir == CACHEDIR:
+    return os.path.join(os.path.dirname(path), CACHEDIR, base)
+  # A shared directory, scripts of the same name must not collide
+  tag = hashlib.sha1(os.path.abspath(path)).hexdigest()[:12]
+  return os.path.join(cachedir, '%s.%s' % (tag, base))
+
+class Encoder:
+  """
+  Builds a cache from forms as they are read. It is only complete, and worth
+  saving, when the whole script was read without an error.
+  """
+  def __init__(self):
+    self.symbols = {}
+    self.strings = []
+    self.numbers = {}
+    self.code = array.array('i')
+    self.starts = []
+    self.failed = False
+    self.complete = False
+  def add(self, sexp, start):
+    self.node(sexp)
+    self.starts.append(start)
+  def fail(self):
+    self.failed = True
+  def done(self):
+    self.complete = not self.failed
+  def intern(self, table, value):
+    idx = table.get(value)
+    if idx is None:
+      idx = table[value] = len(table)
+    return idx
+  def node(self, e):
+    code = self.code
+    # Walk the spine in a loop, lists can be much longer than the stack
+    if type(e) is Pair:
+      items = []
+      while type(e) is Pair:
+        items.append(e.car)
+        e = e.cdr
+      code.append(LIST)
+      code.append(len(items))
+      for item in items:
+        self.node(item)
+    if e is Null:
+      code.append(NULL)
+    elif e is T:
+      code.append(TRUE)
+    elif e is F:
+      code.append(FALSE)
+    elif type(e) is Symbol:
+      code.append(SYMBOL)
+      code.append(self.intern(self.symbols, e.value))
+    elif type(e) is String:
+      # Not shared, eqv? tells string literals apart
+      code.append(STRING)
+      code.append(len(self.strings))
+      self.strings.append(e.value)
+    else:
+      code.append(NUMBER)
+      code.append(self.intern(self.numbers, e.value))
+  def dumps(self, key):
+    def table(d):
+      return [v for v, i in sorted(d.items(), key=lambda kv: kv[1])]
+    return marshal.dumps(('KUAO', CACHEFORMAT, key, table(self.symbols),
+                          self.strings, table(self.numbers),
+                          self.code.tostring(), self.starts))
+
+def decode(data, key):
+  """
+  The forms stored in data with where they start, or None when it's not a
+  cache of key. They are made one at a time, as the script runs.
+  """
+  try:
+    magic, fmt, k, symbols, strings, numbers, code, starts = marshal.loads(data)
+    if magic != 'KUAO' or fmt != CACHEFORMAT or k != key:
+      return None
+    code = array.array('i', code)
+  except (EOFError, ValueError, TypeError):
+    return None
+  symbols = [Symbol(s) for s in symbols]
+  numbers = [Number(n) for n in numbers]
+  pos = [0]
+  def node():
+    i = pos[0]
+    tag = code[i]
+    if tag == LIST:
+      n = code[i + 1]
+      pos[0] = i + 2
+      items = [node() for j in xrange(n)]
+      ret = node()
+      for item in reversed(items):
+        ret = Pair(item, ret)
+      return ret
+    elif tag == SYMBOL:
+      pos[0] = i + 2
+      return symbols[code[i + 1]]
+    elif tag == STRING:
+      pos[0] = i + 2
+      return String(strings[code[i + 1]])
+    elif tag == NUMBER:
+      pos[0] = i + 2
+      return numbers[code[i + 1]]
+    pos[0] = i + 1
+    if tag == NULL:
+      return Null
+    return T if tag == TRUE else F
+  return ((node(), tuple(start)) for start in starts)
+
+def loadcache(path, key):
+  try:
+    data = open(path, 'rb').read()
+  except IOError:
+    return None
+  return decode(data, key)
+
+def savecache(path, data):
+  """Writes a cache file, quietly giving up when that's not possible."""
+  tmp = '%s.%d.tmp' % (path, os.getpid())
+  try:
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(tmp, 'wb') as f:
+      f.write(data)
+    os.rename(tmp, path)
+  except (IOError, OSError):
+    try:
+      os.remove(tmp)
+    except OSError:
+      pass
+
+def runfile(path, keepgoing=False):
+  """
+  Runs the script at path like run, taking its forms from the parse cache
+  when the cache has them for this exact source and interpreter. Otherwise
+  the script is streamed as usual, and cached on the way when it reads
+  without errors.
+  """
+  if cachedir is None or os.path.getsize(path) > CACHEMAX:
+    return run(open(path), path, keepgoing)
+  cpath = cachepath(path)
+  forms = loadcache(cpath, cachekey(open(path, 'rb')))
+  if forms is not None:
+    return runforms(forms, path, keepgoing)
+  strm = Hashed(open(path))
+  encoder = Encoder()
+  errors = run(strm, path, keepgoing, encoder)
+  if encoder.complete:
+    savecache(cpath, encoder.dumps(strm.key.hexdigest()))
+  return errors
 
 def main():
-  strm = open(sys.argv[1]) if len(sys.argv) > 1 else sys.stdin
+  opts = argparse.ArgumentParser(description='Kuao interpreter')
+  opts.add_argument('file', nargs='?', help='script to run, stdin if omitted')
+  opts.add_argument('--max-steps', type=int, metavar='N',
+                    help='abort after N evaluation steps')
+  opts.add_argument('--max-pairs', type=int, metavar='N',
+                    help='abort after allocating N pairs')
+  opts.add_argument('--max-seconds', type=float, metavar='S',
+                    help='abort after S seconds of wall time')
+  opts.add_argument('--max-string-bytes', type=int, metavar='N',
+                    help='abort after making N bytes of strings')
+  opts.add_argument('-k', '--keep-going', action='store_true',
+                    help='report errors and carry on with the next form')
+  opts.add_argument('--no-flat-closures', action='store_true',
+                    help='let closures keep their whole defining environment')
+  opts.add_argument('--no-cache', action='store_true',
+                    help='always read scripts from source')
+  opts.add_argument('--cache-dir', metavar='DIR',
+                    help='keep read scripts in DIR instead of %s' % CACHEDIR)
+  args = opts.parse_args()
+  global flatclosures, cachedir
+  flatclosures = not args.no_flat_closures
+  if args.no_cache:
+    cachedir = None
+  elif args.cache_dir:
+    cachedir = args.cache_dir
+  strm = open(args.file) if args.file else sys.stdin
+  name = args.file or '<stdin>'
+  interactive = strm is sys.stdin and strm.isatty()
   # Hack to load the boot file
   boot = os.path.dirname(os.path.abspath(__file__)) + '/boot.ss'
-  repl(open(boot), False)
-  repl(strm, strm is sys.stdin)
+  if runfile(boot):
+    sys.exit(1)
+  def start():
+    if interactive:
+      repl(strm)
+      return 0
+    if args.file and os.path.isfile(args.file):
+      # Pipes and such are still run as they are read
+      return runfile(args.file, args.keep_going)
+    return run(strm, name, args.keep_going)
+  try:
+    budgets = (args.max_steps, args.max_pairs, args.max_seconds,
+               args.max_string_bytes)
+    if budgets == (None, None, None, None):
+      errors = start()
+    else:
+      try:
+        with Limits(*budgets):
+          errors = start()
+      except LimitExceeded as e:
+        output.flush()
+        sys.exit(str(e))
+  finally:
+    output.flush()
+  if errors:
+    sys.exit(1)
 
 if __name__ == '__main__':
   main()
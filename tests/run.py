@@ -0,0 +1,212 @@
+#!/usr/bin/python
+"""
+Golden output tests for the programs in this directory.
+
+Each foo.ss has its expected stdout recorded in foo.out and, when the program
+fails, the last line of its stderr in foo.err. With --diff every program is
+also run through each evaluation engine in ENGINES, which must all agree with
+the golden output, and the relative speed of the engines is reported.
+
+A program whose first line is a comment like '; args: --max-steps 100' is run
+with those extra command line arguments. Timings in errors are masked, as are
+the resources used when a time limit runs out, since they vary from run to run.
+
+The parse cache is checked as well, on a scratch script: a second run must
+take its forms from the cache, an edit must replace it and a corrupt cache
+must be read around.
+
+  python tests/run.py                  # check against the golden files
+  python tests/run.py --record         # rewrite the golden files
+  python tests/run.py --diff fib.ss    # compare all engines on fib.ss
+"""
+
+import os
+import sys
+import re
+import glob
+import shutil
+import marshal
+import timeit
+import difflib
+import argparse
+import tempfile
+import subprocess
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+KUAO = os.path.join(os.path.dirname(TESTS), 'kuao.py')
+
+# Name and extra command line arguments of every way to run a program
+ENGINES = [
+  ('default', []),
+  ('metered', ['--max-steps', str(10 ** 12)]),
+  ('chained', ['--no-flat-closures']),
+  ('uncached', ['--no-cache']),
+]
+
+# Parts of error lines that differ between runs, and what to put instead
+MASKS = [
+  (re.compile(r'(time limit of \S+ exceeded) \(used [^)]*\)'), r'\1 (used ...)'),
+  (re.compile(r'\d+\.\d+s\)'), 'N.NNNs)'),
+]
+
+class Result:
+  def __init__(self, out, err, status, elapsed):
+    self.out = out
+    self.err = err
+    self.status = status
+    self.elapsed = elapsed
+  def __eq__(self, other):
+    return (self.out, self.err) == (other.out, other.err)
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+def flags(path):
+  """The extra arguments from an '; args:' first line of the program."""
+  first = open(path).readline()
+  if first.startswith('; args:'):
+    return first[len('; args:'):].split()
+  return []
+
+def run(path, engine=[]):
+  # The program's own arguments come last to override the engine's
+  cmd = [sys.executable, KUAO] + engine + flags(path) + [os.path.basename(path)]
+  start = timeit.default_timer()
+  # Run from here so errors name the program the same way on every machine
+  proc = subprocess.Popen(cmd, cwd=TESTS,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  out, err = proc.communicate()
+  elapsed = timeit.default_timer() - start
+  # Tracebacks differ between engines, the exception itself must not
+  lines = err.strip().splitlines()
+  last = lines[-1] + '\n' if proc.returncode and lines else ''
+  for pattern, repl in MASKS:
+    last = pattern.sub(repl, last)
+  return Result(out, last, proc.returncode, elapsed)
+
+def golden(path):
+  base = os.path.splitext(path)[0]
+  def read(ext):
+    if os.path.exists(base + ext):
+      return open(base + ext).read()
+    return None
+  out = read('.out')
+  if out is None:
+    return None
+  return Result(out, read('.err') or '', None, None)
+
+def record(path, result):
+  base = os.path.splitext(path)[0]
+  open(base + '.out', 'w').write(result.out)
+  if result.err:
+    open(base + '.err', 'w').write(result.err)
+  elif os.path.exists(base + '.err'):
+    os.remove(base + '.err')
+
+def diff(expected, actual, name):
+  lines = difflib.unified_diff(
+      (expected.out + expected.err).splitlines(True),
+      (actual.out + actual.err).splitlines(True),
+      'expected', name)
+  return ''.join(list(lines)[:40])
+
+def checkcache():
+  """What went wrong with the parse cache of a scratch script, if anything."""
+  tmp = tempfile.mkdtemp()
+  path = os.path.join(tmp, 'cached.ss')
+  cache = os.path.join(tmp, '__kuaocache__', 'cached.ss.kc')
+  def kuao(src):
+    open(path, 'w').write(src)
+    proc = subprocess.Popen([sys.executable, KUAO, path],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    return out + err
+  def written():
+    # A cache is written aside and renamed into place, so a new file
+    return os.stat(cache).st_ino if os.path.exists(cache) else None
+  def corrupt(fn):
+    data = list(marshal.loads(open(cache, 'rb').read()))
+    open(cache, 'wb').write(fn(data))
+  square = '(define (sq x) (* x x))\n(display (sq %d))\n'
+  try:
+    if kuao(square % 7) != '49' or written() is None:
+      return 'first run was not cached'
+    ino = written()
+    if kuao(square % 7) != '49' or written() != ino:
+      return 'second run did not use the cache'
+    if kuao(square % 8) != '64' or written() == ino:
+      return 'cache was not replaced after an edit'
+    # Right key but a broken payload, then not even a cache
+    def badcode(data):
+      data[6] = data[6][:-1]
+      return marshal.dumps(tuple(data))
+    for fn in [badcode, lambda data: 'KUAO' + marshal.dumps(data)[:20]]:
+      corrupt(fn)
+      ino = written()
+      if kuao(square % 8) != '64' or written() == ino:
+        return 'corrupt cache was not read around'
+    return None
+  finally:
+    shutil.rmtree(tmp)
+
+def main():
+  opts = argparse.ArgumentParser(description='Kuao golden output tests')
+  opts.add_argument('names', nargs='*', metavar='program',
+                    help='programs to run, all *.ss here if omitted')
+  opts.add_argument('--record', action='store_true',
+                    help='record the output of the default engine')
+  opts.add_argument('--diff', action='store_true',
+                    help='run every engine and compare them')
+  args = opts.parse_args()
+  if args.names:
+    paths = [os.path.join(TESTS, os.path.basename(n)) for n in args.names]
+  else:
+    paths = sorted(glob.glob(os.path.join(TESTS, '*.ss')))
+  engines = ENGINES if args.diff else ENGINES[:1]
+  failed = 0
+  totals = dict((name, 0.0) for name, _ in engines)
+  for path in paths:
+    name = os.path.basename(path)
+    results = [(ename, run(path, eargs)) for ename, eargs in engines]
+    for ename, result in results:
+      totals[ename] += result.elapsed
+    if args.record:
+      record(path, results[0][1])
+      print 'recorded', name
+      continue
+    expected = golden(path)
+    if expected is None:
+      print 'MISSING %s (run with --record)' % name
+      failed += 1
+      continue
+    bad = [(ename, r) for ename, r in results if r != expected]
+    if bad:
+      failed += 1
+      for ename, r in bad:
+        print 'FAIL %s [%s]' % (name, ename)
+        sys.stdout.write(diff(expected, r, ename))
+    elif args.diff:
+      base = results[0][1].elapsed
+      print 'ok   %-12s %s' % (name, ' '.join(
+          '%s=%.2fx' % (ename, r.elapsed / base) for ename, r in results))
+    else:
+      print 'ok   %s' % name
+  if args.diff:
+    base = totals[engines[0][0]]
+    print
+    for ename, _ in engines:
+      print '%-10s %8.3fs %6.2fx' % (ename, totals[ename], totals[ename] / base)
+  checks = len(paths)
+  if not args.names and not args.record:
+    checks += 1
+    problem = checkcache()
+    if problem:
+      failed += 1
+      print 'FAIL parse cache: %s' % problem
+    else:
+      print 'ok   parse cache'
+  if failed:
+    print '%d of %d failed' % (failed, checks)
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()